@@ -77,7 +77,8 @@ def extract_patches(args) -> List[dict]:
         m = patches_msk[p]
         
         if args.adirandel > 0:
-            m = u.add_rand_mask(m, args.adirandel)
+            # patches are disjoint slices of a fresh array, no need to copy them
+            m = u.add_rand_mask(m, args.adirandel, inplace=True)
         
         outputs.append({'image': i * args.gain, 'mask': m, 'name': str(p).zfill(_zeros)})
     
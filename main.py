@@ -64,16 +64,14 @@ class Training:
         # build a noise tensor
         data_shape = self.img.shape[:-1]
         self.input_ = u.get_noise(shape=(1, self.args.inputdepth) + data_shape,
-                                  noise_type=self.args.noise_dist).type(self.dtype)
-        self.input_ *= self.args.noise_std
+                                  noise_type=self.args.noise_dist,
+                                  scale=self.args.noise_std).type(self.dtype)
         
         if self.args.filter_noise_with_wavelet:
-            self.input_ = u.np_to_torch(
-                u.filter_noise_traces(
-                    self.input_.detach().clone().cpu().numpy(),
-                    np.load(os.path.join(self.args.imgdir, 'wavelet.npy'))
-                )
-            ).type(self.dtype)
+            self.input_ = u.filter_noise_traces_torch(
+                self.input_.detach(),
+                u.np_to_torch(np.load(os.path.join(self.args.imgdir, 'wavelet.npy')))
+            )
             
         if self.args.data_forgetting_factor != 0:
             # build decimated data tensor
@@ -304,6 +302,8 @@ class Training:
 def main() -> None:
     args = parse_arguments()
     
+    if args.deterministic:
+        u.set_seed(deterministic=True)
     u.set_gpu(args.gpu)
     
     # create output folder and save arguments in a .txt file
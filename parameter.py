@@ -32,7 +32,9 @@ def parse_arguments() -> Namespace:
                         choices=['multiunet', 'attmultiunet', 'part', 'multiunet3d', 'load'],
                         help='The architecture')
     parser.add_argument('--gpu', type=int, required=False, default=-1,
-                        help='GPU to use (default lowest memory usage)')
+                        help='GPU to use (default most free memory)')
+    parser.add_argument('--deterministic', action='store_true', default=False,
+                        help='Use deterministic cuDNN algorithms for bit-reproducible runs (slower)')
     parser.add_argument('--activation', type=str, default='LeakyReLU', required=False,
                         choices=['LeakyReLU', 'ReLU', 'Tanh'],
                         help='Activation function to be used in the convolution block')
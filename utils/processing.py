@@ -1,40 +1,95 @@
 import numpy as np
 from scipy.ndimage import convolve1d
+from scipy.signal import fftconvolve
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
-def normalize(image, time_step, velo):
-    nt, nx, ny = image.shape
-    step = time_step * velo
-    t = np.linspace(step, nt * step, nt)
-    t = np.tile(t, (nx, ny, 1)).transpose(-1, 0, 1)
-    gain = np.sqrt(t)
+# below this size the numpy path is faster than spawning the numba threads
+_BOOL2BIN_NUMBA_MIN_SIZE = int(1e6)
+# above this filter length the FFT convolution beats the direct one
+_FFTCONVOLVE_MIN_FILTER_SIZE = 256
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _bool2bin_kernel(x, true_val, false_val, out):
+        for i in prange(x.size):
+            out[i] = false_val if np.isnan(x[i]) else true_val
+
+
+def _time_gain(image, step):
+    """Square-root time gain along the first axis of `image`, broadcastable over the other axes."""
+    gain = np.sqrt(np.arange(1, image.shape[0] + 1, dtype=np.float64) * step)
+    if np.issubdtype(image.dtype, np.floating):
+        gain = gain.astype(image.dtype, copy=False)
+    return gain.reshape((-1,) + (1,) * (image.ndim - 1))
+
+
+def normalize(image, time_step, velo, out=None):
+    """Apply the sqrt(t) gain to `image`.
     
-    return image * gain
+    `out` is the array the result is written to; pass `out=image` to work in place
+    (image has to be a float array, otherwise the product cannot be cast back).
+    """
+    gain = _time_gain(image, time_step * velo)
+    
+    if out is None:
+        return image * gain
+    return np.multiply(image, gain, out=out)
 
 
-def denormalize(image, time_step, velo):
-    nt, nx, ny = image.shape
-    step = time_step * velo
-    t = np.linspace(step, nt * step, nt)
-    t = np.tile(t, (nx, ny, 1)).transpose(-1, 0, 1)
-    gain = np.sqrt(t)
+def denormalize(image, time_step, velo, out=None):
+    """Remove the sqrt(t) gain from `image`.
+    
+    `out` is the array the result is written to; pass `out=image` to work in place
+    (image has to be a float array, otherwise the quotient cannot be cast back).
+    """
+    gain = _time_gain(image, time_step * velo)
     
-    return image / gain
+    if out is None:
+        return image / gain
+    return np.divide(image, gain, out=out)
 
 
 def bool2bin(in_content: np.ndarray, logic: bool = True):
-    temp = in_content.copy()
-    temp[np.isnan(temp) == False] = 1 if logic else 0
-    temp[np.isnan(temp) == True] = 0 if logic else 1
-    return temp
+    if (njit is not None
+            and in_content.dtype in (np.float32, np.float64)
+            and in_content.size >= _BOOL2BIN_NUMBA_MIN_SIZE
+            and in_content.flags.c_contiguous):
+        out = np.empty_like(in_content)
+        _bool2bin_kernel(in_content.ravel(), 1 if logic else 0, 0 if logic else 1, out.ravel())
+        return out
+    
+    nans = np.isnan(in_content)
+    if logic:
+        nans = np.logical_not(nans, out=nans)
+    return nans.astype(in_content.dtype, copy=False)
 
 
 def filter_noise_traces(in_content: np.ndarray, filt: np.ndarray) -> np.ndarray:
+    """
+    Convolve the traces along axis 2 with the 1D filter `filt` (reflected boundaries).
+    NumPy implementation for library use; the training scripts filter the noise tensor
+    on its device with `filter_noise_traces_torch`.
+    """
     assert filt.ndim == 1, "filter has to be a 1D array"
 
-    filtered = convolve1d(in_content, filt, axis=2)
+    axis = 2
+    if filt.size <= _FFTCONVOLVE_MIN_FILTER_SIZE:
+        return convolve1d(in_content, filt, axis=axis)
+    
+    # reproduce the 'reflect' boundary and centering of convolve1d
+    pad = [(0, 0)] * in_content.ndim
+    pad[axis] = (filt.size - 1 - filt.size // 2, filt.size // 2)
+    shape = [1] * in_content.ndim
+    shape[axis] = -1
+    filtered = fftconvolve(np.pad(in_content, pad, mode='symmetric'), filt.reshape(shape),
+                           mode='valid', axes=axis)
     
-    return filtered
+    # convolve1d keeps the input dtype, fftconvolve promotes to the filter one
+    return filtered.astype(in_content.dtype, copy=False)
 
 
 __all__ = [
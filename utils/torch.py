@@ -1,10 +1,11 @@
 import numpy as np
 import torch
 import torch.nn.functional as F
-from GPUtil import getFirstAvailable, getGPUs
+import pynvml
+from collections import namedtuple
+from functools import lru_cache
 from termcolor import colored
 import os
-from cv2 import dilate
 from .generic import nextpow2
 
 
@@ -18,26 +19,25 @@ def init_weights(net, init_type='normal', init_gain=0.02):
 
     We use 'xavier' for the network.
     """
-    from termcolor import colored
+    init_fns = {
+        'normal': lambda w: torch.nn.init.normal_(w, 0.0, init_gain),
+        'xavier': lambda w: torch.nn.init.xavier_normal_(w, gain=init_gain),
+        'kaiming': lambda w: torch.nn.init.kaiming_normal_(w, a=0.2, mode='fan_in'),
+        'orthogonal': lambda w: torch.nn.init.orthogonal_(w, gain=init_gain),
+        'default': None,
+    }
+    if init_type not in init_fns:
+        raise NotImplementedError(
+            'initialization method [%s] is not implemented' % init_type)
+    init_weight = init_fns[init_type]
     
     def init_func(m):  # define a initialization function
-        classname = m.__class__.__name__
-        if hasattr(m, 'weight') and (classname.find('Conv') != -1 or classname.find('Linear') != -1):
-            if init_type == 'normal':
-                torch.nn.init.normal_(m.weight.data, 0.0, init_gain)
-            elif init_type == 'xavier':
-                torch.nn.init.xavier_normal_(m.weight.data, gain=init_gain)
-            elif init_type == 'kaiming':
-                torch.nn.init.kaiming_normal_(m.weight.data, a=0.2, mode='fan_in')
-            elif init_type == 'orthogonal':
-                torch.nn.init.orthogonal_(m.weight.data, gain=init_gain)
-            else:
-                raise NotImplementedError(
-                    'initialization method [%s] is not implemented' % init_type)
-            if hasattr(m, 'bias') and m.bias is not None:
+        if isinstance(m, (torch.nn.modules.conv._ConvNd, torch.nn.Linear)):
+            init_weight(m.weight.data)
+            if m.bias is not None:
                 torch.nn.init.constant_(m.bias.data, 0.0)
         # BatchNorm Layer's weight is not a matrix; only normal distribution applies.
-        elif classname.find('BatchNorm') != -1:
+        elif isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
             torch.nn.init.normal_(m.weight.data, 10.0, init_gain * 10)
             torch.nn.init.constant_(m.bias.data, 0.0)
     
@@ -46,9 +46,17 @@ def init_weights(net, init_type='normal', init_gain=0.02):
         print(colored('parameters initialized with %s' % init_type, 'cyan'))
 
 
-def get_noise(shape: tuple or list, noise_type: str) -> torch.Tensor:
-    """Build a tensor of a given shape with noise of type `noise_type`."""
-    x = torch.zeros(shape)
+def get_noise(shape: tuple or list, noise_type: str, scale: float = 1., device=None,
+              dtype: torch.dtype = None) -> torch.Tensor:
+    """Build a tensor of a given shape with noise of type `noise_type`, multiplied by `scale`.
+    The tensor is allocated directly on `device` (default: CPU) with the given `dtype`
+    (default: torch.get_default_dtype())."""
+    if dtype is None:
+        dtype = torch.get_default_dtype()
+    # float16 cauchy noise is drawn and scaled in single precision before casting, so that
+    # fewer of its heavy-tailed draws exceed the float16 range (the most extreme still become inf)
+    x = torch.empty(shape, device=device,
+                    dtype=torch.float32 if dtype == torch.float16 and noise_type == 'c' else dtype)
     
     if noise_type == 'u':
         x.uniform_()
@@ -58,10 +66,13 @@ def get_noise(shape: tuple or list, noise_type: str) -> torch.Tensor:
         x.cauchy_()
     else:
         raise ValueError("Noise type has to be one of [u, n, c]")
-    return x
+    if scale != 1.:
+        x.mul_(scale)
+    return x.to(dtype)
 
 
-def build_noise_tensor(input_depth, spatial_size, method='noise', noise_type='u', var=1. / 10):
+def build_noise_tensor(input_depth, spatial_size, method='noise', noise_type='u', var=1. / 10, device=None,
+                       dtype=None):
     """Returns a pytorch.Tensor of size (1 x `input_depth` x `spatial_size[0]` x `spatial_size[1]`)
     initialized in a specific way.
     Args:
@@ -70,6 +81,8 @@ def build_noise_tensor(input_depth, spatial_size, method='noise', noise_type='u'
         spatial_size: spatial size of the tensor to initialize
         noise_type: 'u' for uniform; 'n' for normal
         var: a factor, a noise will be multiplicated by. Basically it is standard deviation scaler.
+        device: the device the tensor is allocated on.
+        dtype: the precision of the tensor, e.g. torch.float16 for mixed-precision networks.
     """
     if isinstance(spatial_size, int):
         spatial_size = (spatial_size, spatial_size)
@@ -81,16 +94,47 @@ def build_noise_tensor(input_depth, spatial_size, method='noise', noise_type='u'
     else:
         assert False
     
-    net_input = get_noise(shape, noise_type) * var
+    net_input = get_noise(shape, noise_type, scale=var, device=device, dtype=dtype)
     
     return net_input
 
 
+def filter_noise_traces_torch(in_content: torch.Tensor, filt: torch.Tensor) -> torch.Tensor:
+    """
+    Torch counterpart of `filter_noise_traces`: convolve the traces along dim 2
+    with the 1D filter `filt`, on the device of `in_content`.
+    Boundaries are reflected as in scipy.ndimage.convolve1d.
+    """
+    assert filt.ndim == 1, "filter has to be a 1D array"
+    
+    dim = 2
+    size = filt.numel()
+    x = in_content.transpose(dim, -1)
+    shape = x.shape
+    x = x.reshape(-1, 1, shape[-1])
+    
+    # reflect the trace boundaries (d c b a | a b c d | d c b a ...), repeatedly if the filter
+    # is longer than the trace
+    nt = shape[-1]
+    left = size - 1 - size // 2
+    idx = torch.arange(-left, nt + size // 2, device=x.device) % (2 * nt)
+    idx = torch.where(idx < nt, idx, 2 * nt - 1 - idx)
+    x = x.index_select(-1, idx)
+    # conv1d computes a correlation, so the filter is flipped
+    weight = filt.flip(0).view(1, 1, -1).to(device=x.device, dtype=x.dtype)
+    filtered = F.conv1d(x, weight)
+    
+    return filtered.reshape(shape).transpose(dim, -1)
+
+
 def np_to_torch(in_content: np.ndarray) -> torch.Tensor:
     """
     Converts image in numpy.array to torch.Tensor.
     From C x W x H [0..1] to  C x W x H [0..1]
+    Non-contiguous arrays are copied to a contiguous layout, the others are shared.
     """
+    if not in_content.flags.c_contiguous:
+        in_content = np.ascontiguousarray(in_content)
     return torch.from_numpy(in_content)
 
 
@@ -99,7 +143,10 @@ def torch_to_np(in_content: torch.Tensor) -> np.ndarray:
     Converts an image in torch.Tensor format to np.array.
     From 1 x C x W x H [0..1] to  C x W x H [0..1]
     """
-    return in_content.detach().cpu().numpy()[0]
+    in_content = in_content.detach()
+    if in_content.device.type != 'cpu':
+        in_content = in_content.cpu()
+    return in_content.numpy()[0]
 
 
 def get_params(opt_over, net, net_input, downsampler=None):
@@ -129,83 +176,112 @@ def get_params(opt_over, net, net_input, downsampler=None):
     return params
 
 
+GPU = namedtuple('GPU', ['index', 'name', 'free_mem'])
+
+
+@lru_cache(maxsize=None)
+def _get_gpus() -> tuple:
+    """The GPUs of the machine as (index, name, free_mem) tuples, queried once per run through NVML."""
+    pynvml.nvmlInit()
+    try:
+        gpus = []
+        for i in range(pynvml.nvmlDeviceGetCount()):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+            name = pynvml.nvmlDeviceGetName(handle)
+            gpus.append(GPU(i, name.decode() if isinstance(name, bytes) else name,
+                            pynvml.nvmlDeviceGetMemoryInfo(handle).free))
+    finally:
+        pynvml.nvmlShutdown()
+    return tuple(gpus)
+
+
+def _first_available_gpu(gpus) -> int:
+    """Index of the GPU with the most free memory."""
+    if not gpus:
+        raise RuntimeError('Could not find an available GPU.')
+    return max(gpus, key=lambda g: g.free_mem).index
+
+
 def set_gpu(id=-1):
     """
-    Set GPU device or select the one with the lowest memory usage (None for
+    Set GPU device or select the one with the most free memory (None for
     CPU-only)
     """
     if id is None:
         # CPU only
         print(colored('GPU not selected', 'yellow'))
     else:
+        gpus = _get_gpus()
         # -1 for automatic choice
-        device = id if id != -1 else getFirstAvailable(order='memory')[0]
+        device = id if id != -1 else _first_available_gpu(gpus)
         try:
-            name = getGPUs()[device].name
+            name = gpus[device].name
         except IndexError:
             print('The selected GPU does not exist. Switching to the most '
                   'available one.')
-            device = getFirstAvailable(order='memory')[0]
-            name = getGPUs()[device].name
+            device = _first_available_gpu(gpus)
+            name = gpus[device].name
         
         print(colored('GPU selected: %d - %s' % (device, name), 'yellow'))
         os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
 
 
 def get_gpu_name(id: int) -> str:
-    name = getGPUs()[id].name
+    name = _get_gpus()[id].name
     return '%s (%d)' % (name, id)
 
 
-def set_seed(seed=0):
+def set_seed(seed=0, deterministic=False):
     """
         Set the seed of random.
+        With `deterministic` cuDNN is restricted to deterministic algorithms, which makes
+        runs bit-reproducible at the cost of speed; otherwise cuDNN benchmarks and picks
+        the fastest ones.
     """
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     
     torch.backends.cudnn.enabled = True
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cudnn.deterministic = deterministic
 
 
-def add_rand_mask(mask, perc=0.3):
+def add_rand_mask(mask, perc=0.3, inplace=False):
     """
         add the addictive random missing points to the mask.
         parameter:
             mask -- the mask(2D or 3D), which should be (nt, nx), (nt, nx, ny)
             perc -- the percent of addictive deleting samples
+            inplace -- modify `mask` instead of a copy of it
 
         return:
             the processed new makk
     """
-    m = mask.copy()
-    points = np.argwhere(m[0] == 1)
-    rr = np.random.choice(np.arange(points.shape[0]), int(points.shape[0] * perc), replace=False)
-    if m.ndim == 2:
-        for p in points[rr]:
-            m[:, p[0]] = 0
-    else:
-        for p in points[rr]:
-            m[:, p[0], p[1]] = 0
+    m = mask if inplace else mask.copy()
+    points = np.flatnonzero(m[0] == 1)
+    rr = np.random.choice(points.size, int(points.size * perc), replace=False)
+    m[(slice(None),) + np.unravel_index(points[rr], m.shape[1:])] = 0
     return m
 
 
 def dilate_mask(mask, iterations=1):
-    kernel = np.ones((2, 2), np.uint8)
+    """
+        Dilate each 2D slice (last two dims) of the mask with a 2x2 kernel,
+        as cv2.dilate does, running max-pooling on the device of the mask.
+        A mask that squeezes to 2D is dilated row by row, along its last dim only.
+    """
     ddtype = mask.dtype
-    device = mask.device
-    mask_np = mask.clone().detach().cpu().numpy()
-    shape = mask_np.shape
-    mask_np = mask_np.squeeze()
-    mask_res = np.empty_like(mask_np)
-    for i in range(mask_np.shape[0]):
-        m = mask_np[i].astype(np.uint8)
-        mask_res[i] = dilate(m, kernel, iterations=iterations)
+    shape = mask.shape
+    mask_res = mask.detach().reshape(-1, 1, *shape[-2:]).float()
+    # `iterations` dilations with the 2x2 kernel (anchored at its bottom-right element)
+    # amount to a single one with a (iterations + 1) square kernel; a squeezed 2D mask
+    # was dilated one row at a time by cv2, i.e. along the last dim only
+    rows = iterations if mask.squeeze().ndim > 2 else 0
+    mask_res = F.pad(mask_res, (iterations, 0, rows, 0), value=float('-inf'))
+    mask_res = F.max_pool2d(mask_res, kernel_size=(rows + 1, iterations + 1), stride=1)
     
-    mask_res = torch.from_numpy(mask_res.reshape(shape)).type(ddtype).to(device)
-    return mask_res
+    return mask_res.reshape(shape).type(ddtype)
 
 
 def data_parallel(module, input, device_ids, output_device):
@@ -223,6 +299,8 @@ class MaskUpdate:
         self.iter = 0
         self.new_mask = mask
         self.old_mask = mask
+        # indices of the samples enabled by the last dilation
+        self._diff_idx = None
     
     def update(self, iiter):
         mask_return = self.old_mask
@@ -231,13 +309,16 @@ class MaskUpdate:
             if iiter_dil > self.iter:
                 self.old_mask = self.new_mask
                 self.new_mask = dilate_mask(self.old_mask)
+                self._diff_idx = (self.new_mask != self.old_mask).nonzero(as_tuple=True)
                 self.iter = iiter_dil
             iter_drop = (iiter - self.threshold) % self.step
             p = 1. - 1. / self.step * (iter_drop + 1)
-            mask_add = F.dropout(self.new_mask - self.old_mask, p)
-            mask_add[mask_add != 0] = 1
+            # enable each new sample with probability 1 - p
+            keep = torch.rand(self._diff_idx[0].numel(), device=self.old_mask.device) >= p
+            keep_idx = tuple(idx[keep] for idx in self._diff_idx)
             
-            mask_return = self.old_mask + mask_add
+            mask_return = self.old_mask.clone()
+            mask_return[keep_idx] = self.new_mask[keep_idx]
         return mask_return
 
 
@@ -253,18 +334,16 @@ class EarlyStopping(object):
     """
     
     def __init__(self, patience: int = 10, max: bool = False, min_delta: float = 0, percentage: bool = False):
-        self.mode = 'max' if max else 'min'
         self.min_delta = min_delta
         self.patience = patience
         self.percentage = percentage
         self.best = None
         self.num_bad_epochs = 0
-        self.is_better = None
-        self._init_is_better()
+        # metrics improves when sign * (metrics - best) < -delta
+        self._sign = -1 if max else 1
         self.msg = "\nEarly stopping called, terminating..."
         
         if patience == 0:
-            self.is_better = lambda a, b: True
             self.step = lambda a: False
     
     def step(self, metrics) -> bool:
@@ -272,11 +351,12 @@ class EarlyStopping(object):
             self.best = metrics
             return False
         
-        if torch.isnan(metrics):
+        if metrics != metrics:  # NaN
             print("Metrics is NaN, terminating...")
             return True
         
-        if self.is_better(metrics, self.best):
+        delta = self.best * self.min_delta / 100 if self.percentage else self.min_delta
+        if self._sign * (metrics - self.best) < -delta:
             self.num_bad_epochs = 0
             self.best = metrics
         else:
@@ -287,25 +367,12 @@ class EarlyStopping(object):
             return True
         
         return False
-    
-    def _init_is_better(self):
-        if self.mode not in {'min', 'max'}:
-            raise ValueError('mode ' + self.mode + ' is unknown!')
-        if not self.percentage:
-            if self.mode == 'min':
-                self.is_better = lambda a, best: a < best - self.min_delta
-            if self.mode == 'max':
-                self.is_better = lambda a, best: a > best + self.min_delta
-        else:
-            if self.mode == 'min':
-                self.is_better = lambda a, best: a < best - (best * self.min_delta / 100)
-            if self.mode == 'max':
-                self.is_better = lambda a, best: a > best + (best * self.min_delta / 100)
 
 
 __all__ = [
     "init_weights",
     "get_noise",
+    "filter_noise_traces_torch",
     "np_to_torch",
     "torch_to_np",
     "get_params",